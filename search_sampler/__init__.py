@@ -1,9 +1,13 @@
 import os
+import glob
+import gzip
+import json
+import numpy
 import pandas
 import time
+import zlib
 
 from datetime import datetime, timedelta
-from collections import defaultdict
 from copy import deepcopy
 
 from googleapiclient.discovery import build
@@ -16,6 +20,101 @@ the data are located here.
 VALID_PERIOD_LENGTHS = ["day", "week", "month"]
 
 
+class _SampleAccumulator(object):
+    """
+    Collects sample values for `SearchSampler.pull_rolling_window` in preallocated NumPy arrays indexed by\
+    (term, period, sample), rather than in lists of boxed values per period.
+
+    :param terms: The search terms, in the order they should appear in the output
+    :param lst_periods: A list of valid periods. Values for any other period are ignored.
+    :param num_samples: Amount of samples to keep for each term and period. Any extra samples are dropped.
+
+    """
+
+    def __init__(self, terms, lst_periods, num_samples):
+
+        self._terms = list(terms)
+        self._term_index = dict((term, i) for i, term in enumerate(self._terms))
+        self._periods = pandas.DatetimeIndex(lst_periods)
+        self._num_samples = num_samples
+
+        self._values = numpy.full((len(self._terms), len(self._periods), num_samples), numpy.nan)
+        self._counts = numpy.zeros((len(self._terms), len(self._periods)), dtype=numpy.int64)
+        # Values are stored as floats, but are handed back as integers if that's all the API returned
+        self._integer_values = True
+
+    def _get_term_index(self, term):
+
+        """
+        :param term: A search term
+        :return: The index of the term, growing the arrays if it hasn't been seen before
+
+        """
+
+        if term not in self._term_index:
+            self._term_index[term] = len(self._terms)
+            self._terms.append(term)
+            self._values = numpy.concatenate([
+                self._values,
+                numpy.full((1,) + self._values.shape[1:], numpy.nan)
+            ])
+            self._counts = numpy.concatenate([
+                self._counts,
+                numpy.zeros((1,) + self._counts.shape[1:], dtype=numpy.int64)
+            ])
+        return self._term_index[term]
+
+    def add(self, term, df):
+
+        """
+        Adds one sample to each period in df
+
+        :param term: The search term the values belong to
+        :param df: Dataframe with sample values. Must at least have the columns [period, value]
+        :return: None
+
+        """
+
+        term_index = self._get_term_index(term)
+        period_index = self._periods.get_indexer(pandas.DatetimeIndex(df['period']))
+        if not numpy.issubdtype(df['value'].dtype, numpy.integer):
+            self._integer_values = False
+        values = df['value'].to_numpy(dtype=numpy.float64)
+
+        # Only keep periods that were asked for
+        valid = period_index >= 0
+        period_index = period_index[valid]
+        values = values[valid]
+
+        # Each period appears once per response, so the next free sample slot can be filled all at once
+        slots = self._counts[term_index, period_index]
+        keep = slots < self._num_samples
+        self._values[term_index, period_index[keep], slots[keep]] = values[keep]
+        self._counts[term_index, period_index] += 1
+
+    def to_dataframe(self, query_time):
+
+        """
+        :param query_time: Time the query was run
+        :return: Dataframe with one row per sample, ordered by term, period and sample
+
+        """
+
+        filled = numpy.arange(self._num_samples) < self._counts[:, :, numpy.newaxis]
+        term_index, period_index, sample = numpy.nonzero(filled)
+        values = self._values[filled]
+        if self._integer_values:
+            values = values.astype(numpy.int64)
+
+        return pandas.DataFrame({
+            "term": numpy.array(self._terms, dtype=object)[term_index],
+            "period": self._periods[period_index],
+            "sample": sample,
+            "value": values,
+            "query_time": query_time
+        })
+
+
 class SearchSampler(object):
     """
     TrendsSampler contains all functions required to sample the Google Health API
@@ -42,6 +141,13 @@ class SearchSampler(object):
     :param version: The API version to use (default is `v1beta`)
     :param output_path: The path to the folder where query results will be saved (folder will be created\
     if it doesn't already exist.)
+    :param archive_path: Optional path to a folder where every raw API response is archived, along with its\
+    request parameters and timestamp. Each sampler writes a new gzip-compressed, append-only JSONL segment to\
+    `{archive_path}/{region}/{region}-{search_name}-{timestamp}.jsonl.gz`.
+    :param replay: If `True`, no requests are made to the API. Responses are instead read back from the\
+    segments in `archive_path` for this region and search name, so results can be rebuilt offline. When the\
+    same request was archived more than once, the most recent response is used. No api_key is needed, and\
+    `pull_rolling_window` reports the time of the earliest archived response it used as its `query_time`.
 
     :Example:
 
@@ -69,16 +175,22 @@ class SearchSampler(object):
             search_params,
             server="https://www.googleapis.com",
             version="v1beta",
-            output_path="data"
+            output_path="data",
+            archive_path=None,
+            replay=False
     ):
 
         # Basic variables
-        if not api_key:
+        if not api_key and not replay:
             raise SystemError('ERROR: Must provide an api_key as the first parameter')
+        if replay and not archive_path:
+            raise SystemError('ERROR: Must provide an archive_path to replay from')
         self._search_name = search_name
         self._server = server
         self._version = version
-        self.service = self._get_service(api_key)
+        self.replay = replay
+        self.archive_path = archive_path
+        self.service = None if replay else self._get_service(api_key)
 
         # Below exception is to ensure that people actually provide something for an output_path
         if output_path == "":
@@ -109,6 +221,13 @@ class SearchSampler(object):
         if self.params['period_end'] < self.params['period_start']:
             raise ValueError('ERROR: start of period must be before end of period')
 
+        # Archive segment for this sampler, and the archived responses when replaying
+        self._archive_segment = None
+        self._archive_file = None
+        self._archived_responses = self._load_archive() if replay else None
+        # Timestamps of the archived responses used since the last reset, to rebuild query_time when replaying
+        self._replayed_timestamps = []
+
     def _get_service(self, api_key):
 
         """
@@ -148,6 +267,145 @@ class SearchSampler(object):
         )
         return (str_path, str_file_name)
 
+    def _get_archive_path(self):
+
+        """
+        :return: 2-tuple containing the archive folder and the file name prefix shared by its segments
+
+        """
+
+        str_path = os.path.join(str(self.archive_path), str(self.params["region"]))
+        str_prefix = '{region}-{identifier}'.format(
+            region=self.params['region'],
+            identifier=self._search_name
+        )
+        return (str_path, str_prefix)
+
+    @staticmethod
+    def _get_query_key(query):
+
+        """
+        :param query: Keyword arguments passed to `getTimelinesForHealth`
+        :return: A string that uniquely identifies the request
+
+        """
+
+        return json.dumps(query, sort_keys=True, default=str)
+
+    def _archive_response(self, query, response_health, request_time):
+
+        """
+        Appends a raw API response, with its request parameters and timestamp, to this sampler's archive segment
+
+        :param query: Keyword arguments passed to `getTimelinesForHealth`
+        :param response_health: Unformatted data from API
+        :param request_time: Time the request was made
+        :return: None
+
+        """
+
+        archive_path, archive_prefix = self._get_archive_path()
+        if not self._archive_segment:
+            if not os.path.exists(archive_path):
+                os.makedirs(archive_path)
+            self._archive_segment = os.path.join(archive_path, '{prefix}-{timestamp}.jsonl.gz'.format(
+                prefix=archive_prefix,
+                timestamp=datetime.now().strftime('%Y%m%d%H%M%S%f')
+            ))
+            print('INFO: Archiving raw responses to: {}'.format(self._archive_segment))
+            # The whole segment is one gzip stream, so records compress against each other
+            self._archive_file = gzip.GzipFile(self._archive_segment, 'wb')
+
+        record = {
+            "timestamp": request_time.isoformat(),
+            "query": query,
+            "response": response_health
+        }
+        # Flushing after each record keeps everything up to the last record readable if a run is interrupted
+        self._archive_file.write((json.dumps(record, default=str) + '\n').encode('utf-8'))
+        self._archive_file.flush()
+
+    def close_archive(self):
+
+        """
+        Finishes this sampler's archive segment. Any further responses are archived to a new segment.
+
+        :return: None
+
+        """
+
+        if self._archive_file:
+            self._archive_file.close()
+        self._archive_file = None
+        self._archive_segment = None
+
+    @staticmethod
+    def _read_segment(segment_path):
+
+        """
+        Reads an archive segment, including one whose gzip stream was never closed because a run was interrupted
+
+        :param segment_path: Path to the segment
+        :return: A list of the JSON lines in the segment
+
+        """
+
+        with open(segment_path, 'rb') as segment:
+            data = segment.read()
+
+        text = b''
+        # A segment may hold more than one gzip member
+        while data:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            text += decompressor.decompress(data)
+            data = decompressor.unused_data
+
+        # Drop a record that was only partly written
+        return [line for line in text.decode('utf-8').split('\n')[:-1] if line.strip()]
+
+    def _load_archive(self):
+
+        """
+        Reads every archived segment for this region and search name
+
+        :return: A dictionary of 2-tuples containing the archive timestamp and the archived response, keyed by\
+        request
+
+        """
+
+        archive_path, archive_prefix = self._get_archive_path()
+        # Match the 20-digit segment timestamp exactly, so searches whose name starts with this one are skipped
+        segment_pattern = '{prefix}-{timestamp}.jsonl.gz'.format(prefix=archive_prefix, timestamp='[0-9]' * 20)
+        segments = sorted(glob.glob(os.path.join(archive_path, segment_pattern)))
+        if not segments:
+            raise ValueError('No archived responses found in {}'.format(archive_path))
+
+        d_responses = {}
+        for segment_path in segments:
+            print('INFO: Loading archive segment: {}'.format(segment_path))
+            for line in self._read_segment(segment_path):
+                record = json.loads(line)
+                # Segments and the records within them are in time order, so later responses win
+                d_responses[self._get_query_key(record['query'])] = (record['timestamp'], record['response'])
+
+        return d_responses
+
+    def _replay_response(self, query):
+
+        """
+        :param query: Keyword arguments that would have been passed to `getTimelinesForHealth`
+        :return: The archived, unformatted data from API for this request
+
+        """
+
+        try:
+            timestamp, response_health = self._archived_responses[self._get_query_key(query)]
+        except KeyError:
+            raise ValueError('No archived response for request: {}'.format(self._get_query_key(query)))
+
+        self._replayed_timestamps.append(timestamp)
+        return response_health
+
     def load_file(self):
 
         """
@@ -265,27 +523,21 @@ class SearchSampler(object):
         else:
             test_region = str(params['region'])
 
+        query = {
+            'terms': params['search_term'],
+            'time_startDate': params['period_start'],
+            'time_endDate': params['period_end'],
+            'timelineResolution': params['period_length']
+        }
         if test_region[:2] == 'US':
             # nation-wide
             if test_region == 'US':
-                graph_health = self.service.getTimelinesForHealth(
-                    terms=params['search_term'],
-                    geoRestriction_country=params['region'],
-                    time_startDate=params['period_start'],
-                    time_endDate=params['period_end'],
-                    timelineResolution=params['period_length']
-                )
+                query['geoRestriction_country'] = params['region']
             # Can only use multiple values for states and DMAs
             # Cannot mix national, state or DMA in the same call, unfortunately
             # Valid options are ISO-3166-2
             else:
-                graph_health = self.service.getTimelinesForHealth(
-                    terms=params['search_term'],
-                    geoRestriction_region=params['region'],
-                    time_startDate=params['period_start'],
-                    time_endDate=params['period_end'],
-                    timelineResolution=params['period_length']
-                )
+                query['geoRestriction_region'] = params['region']
         else:
             # This assumes a DMA
             # To properly retrieve data, it needs to be a number, so test for this first
@@ -295,17 +547,18 @@ class SearchSampler(object):
                                  .format(params['region']))
 
             # otherwise
-            graph_health = self.service.getTimelinesForHealth(
-                terms=params['search_term'],
-                geoRestriction_dma=params['region'],
-                time_startDate=params['period_start'],
-                time_endDate=params['period_end'],
-                timelineResolution=params['period_length']
-            )
+            query['geoRestriction_dma'] = params['region']
 
-        # Now, finally, call the API
+        # Now, finally, call the API (or look up the archived response when replaying)
         print('INFO: Running period {} - {}'.format(params['period_start'], params['period_end']))
-        response_health = self._perform_pull(graph_health)
+        if self.replay:
+            response_health = self._replay_response(query)
+        else:
+            request_time = datetime.now()
+            graph_health = self.service.getTimelinesForHealth(**query)
+            response_health = self._perform_pull(graph_health)
+            if self.archive_path:
+                self._archive_response(query, response_health, request_time)
         if not response_health:
             return None
         else:
@@ -334,86 +587,66 @@ class SearchSampler(object):
             else:
                 raise ValueError("Please provide a proper format for results. Available options are: dict, dataframe.")
 
-    def _serialize_period_values(self, df, dd_periods=None, lst_periods=None):
+    def _get_periods(self):
 
         """
-        Converts sample into period specific list of values. Assumes dd_periods is a defaultdict
+        Works out locally which periods the API will return for the object-level search params. Weeks are
+        assumed to start on a Sunday and months on the first of the month, matching the dates the API reports.
 
-        :param df: Dataframe with sample values. Must at least have the columns [period, value]
-        :param dd_periods: A dictionary, with periods as keys and lists of query results as values
-        :param lst_periods: A list of valid periods
-        :return: dd_periods with added values
+        :return: A list of pandas Timestamps, one per period
 
         """
 
-        if not lst_periods:
-            lst_periods = []
-        if not dd_periods:
-            dd_periods = defaultdict(list)
-
-        for index, row in df.iterrows():
-            # If a list of periods was provided, we only expand dd_periods for the ones that were specified
-            if len(lst_periods) > 0:
-                if row['period'] in lst_periods:
-                    dd_periods[row['period']].append(row['value'])
-            else:
-                dd_periods[row['period']].append(row['value'])
+        period_start = pandas.Timestamp(self.params['period_start'])
+        period_end = pandas.Timestamp(self.params['period_end'])
+        if self.params['period_length'] == 'day':
+            first_period = period_start
+            freq = 'D'
+        elif self.params['period_length'] == 'week':
+            first_period = period_start - timedelta(days=(period_start.dayofweek + 1) % 7)
+            freq = '7D'
+        elif self.params['period_length'] == 'month':
+            first_period = period_start.replace(day=1)
+            freq = 'MS'
+        else:
+            raise SystemError('Period length {} is of the wrong type.'.format(self.params['period_length']))
 
-        return dd_periods
+        return pandas.date_range(first_period, period_end, freq=freq).tolist()
 
-    def pull_rolling_window(self, num_samples=5):
+    def _plan_single_periods(self, lst_periods):
 
         """
-        Separates pull into a rolling set of samples to get multiple samples in the same run.
-        This takes advantage of the fact that the API does not cache results if you change the length of time
-        in the search
-
-        :param num_samples: Amount of samples to pull
-        :return: Dataframe with results from API.  Does not include information about the sample frame.
+        :param lst_periods: A list of valid periods
+        :return: A list of search params, one for each period pulled individually
 
         """
 
-        query_time = datetime.now()
-
-        # First we run a single query, so we can get the dates for each period from the API.
-        # Could do this logic locally, but this is easier
-        local_params = deepcopy(self.params)
-        local_params['search_term'] = local_params['search_term'][0]
-
-        samples_taken = 0
-        d_range_all = self.pull_data_from_api(local_params)
-
-        lst_periods = list(d_range_all.values())[0]['period'].tolist()
-
-        d_periods = {}
-
-        # Next, we pull each week individually. This will always get saved.
-        print("INFO: Running Search Term: {}".format(self.params['search_term']))
+        lst_params = []
         for period in lst_periods:
-
             curr_date = datetime.strftime(period, '%Y-%m-%d')
             local_params = deepcopy(self.params)
             local_params['period_start'] = curr_date
             local_params['period_end'] = curr_date
-            d_single = self.pull_data_from_api(local_params)
-            if not d_single:
-                raise ValueError('Problems with period {}'.format(curr_date))
+            lst_params.append(local_params)
 
-            for term, result in d_single.items():
-                if term in d_periods:
-                    d_periods[term] = self._serialize_period_values(result, dd_periods=d_periods[term])
-                else:
-                    d_periods[term] = self._serialize_period_values(result, dd_periods=defaultdict(list))
+        return lst_params
 
-        # Increment samples taken by 1 - since each period has been sampled individually
-        samples_taken += 1
+    def _plan_windows(self, lst_periods, num_samples, samples_taken=1):
 
-        # Now do the rolling sample
-        # Using some logic to figure out the window size and how far back to go
+        """
+        Using some logic to figure out the window size and how far back to go, lays out the rolling windows
+
+        :param lst_periods: A list of valid periods
+        :param num_samples: Amount of samples to pull
+        :param samples_taken: Samples already taken by pulling each period individually
+        :return: A list of search params, one for each window
+
+        """
+
+        lst_params = []
 
         # First, we get the window size
         window_size = num_samples - samples_taken
-        print("INFO: window_size: {}".format(str(window_size)))
 
         # If in the above samples we've already gotten all that we've asked for, no need to do the rest
         if window_size > 0:
@@ -424,7 +657,6 @@ class SearchSampler(object):
 
             # Calculate days before and after, erring on the side of having more periods...
             # So that we have symmetry between sides if there are an odd number of weeks
-            local_params = deepcopy(self.params)
             days_diff = window_size * 7
 
             # Get the starting period, specifying that the first window is window_size before the first date
@@ -440,35 +672,167 @@ class SearchSampler(object):
             # Loop until each window is done
             while curr_end <= ending_period:
                 # Set up query params
+                local_params = deepcopy(self.params)
                 local_params['period_start'] = datetime.strftime(curr_start, '%Y-%m-%d')
                 local_params['period_end'] = datetime.strftime(curr_end, '%Y-%m-%d')
-                # Call the API
-                d_window = self.pull_data_from_api(local_params)
-                # Save the results
-                for term, result in d_window.items():
-                    d_periods[term] = self._serialize_period_values(
-                        result,
-                        dd_periods=d_periods[term],
-                        lst_periods=lst_periods
-                    )
+                lst_params.append(local_params)
 
                 # Increment the window by one week
                 curr_start += timedelta(days=7)
                 curr_end += timedelta(days=7)
 
-        rows = []
-        for term, timestamps in d_periods.items():
-            for timestamp, samples in timestamps.items():
-                for i, sample in enumerate(samples):
-                    if i < num_samples:
-                        # Due to the sampling method, we sometimes draw an extra sample
-                        # This will skip over that
-                        rows.append({
-                            "term": term,
-                            "period": timestamp,
-                            "sample": i,
-                            "value": sample,
-                            "query_time": query_time
-                        })
-
-        return pandas.DataFrame(rows)
+        return lst_params
+
+    @staticmethod
+    def _estimate_runtime(num_requests, qps, latency, error_rate, workers, sleep_minutes=1, limit=20):
+
+        """
+        Estimates wall time for a number of requests, following the retry and sleep schedule of `_perform_pull`
+
+        :param num_requests: Number of requests to make
+        :param qps: Maximum requests per second allowed by the quota
+        :param latency: Average seconds per request
+        :param error_rate: Probability that any single attempt fails and is retried
+        :param workers: Number of requests in flight at once
+        :param sleep_minutes: Minutes slept after a failed attempt (every fifth failure sleeps for 5 minutes)
+        :param limit: Number of retries before `_perform_pull` gives up
+        :return: 2-tuple containing the expected number of attempts and the expected seconds of wall time
+
+        """
+
+        if not 0 <= error_rate < 1:
+            raise ValueError('error_rate must be at least 0 and less than 1')
+        if not qps > 0:
+            raise ValueError('qps must be greater than 0')
+        if not workers >= 1:
+            raise ValueError('workers must be at least 1')
+        if not latency >= 0:
+            raise ValueError('latency must be at least 0')
+
+        # Expected attempts and sleep per request, summed over the number of failures before a success
+        expected_attempts = 0.0
+        expected_sleep = 0.0
+        sleep = 0.0
+        for failures in range(limit + 1):
+            if failures > 0:
+                sleep += 5 * 60 if failures % 5 == 0 else sleep_minutes * 60
+            if failures < limit:
+                probability = error_rate ** failures * (1 - error_rate)
+            else:
+                # Either the last retry works or the pull gives up
+                probability = error_rate ** failures
+            expected_attempts += probability * (failures + 1)
+            expected_sleep += probability * sleep
+
+        total_attempts = num_requests * expected_attempts
+        # Throughput is bound by whichever is lower: the workers' latency or the quota
+        throughput = min(float(workers) / latency if latency > 0 else float('inf'), qps)
+        seconds = total_attempts / throughput + num_requests * expected_sleep / workers
+
+        return (total_attempts, seconds)
+
+    def pull_rolling_window(self, num_samples=5):
+
+        """
+        Separates pull into a rolling set of samples to get multiple samples in the same run.
+        This takes advantage of the fact that the API does not cache results if you change the length of time
+        in the search
+
+        :param num_samples: Amount of samples to pull
+        :return: Dataframe with results from API.  Does not include information about the sample frame.
+
+        """
+
+        query_time = datetime.now()
+        self._replayed_timestamps = []
+
+        # First we run a single query, so we can get the dates for each period from the API.
+        # Could do this logic locally, but this is easier
+        local_params = deepcopy(self.params)
+        local_params['search_term'] = local_params['search_term'][0]
+
+        samples_taken = 0
+        d_range_all = self.pull_data_from_api(local_params)
+
+        lst_periods = list(d_range_all.values())[0]['period'].tolist()
+
+        # dry_run works these out locally, so flag it if the API disagrees
+        if lst_periods != self._get_periods():
+            print(
+                'WARNING: The periods returned by the API do not match the periods expected locally. '
+                'dry_run will not reflect the queries made for this search.'
+            )
+
+        # Due to the sampling method, we sometimes draw an extra sample
+        # The accumulator only keeps num_samples per period, so it skips over that
+        accumulator = _SampleAccumulator(self.params['search_term'], lst_periods, num_samples)
+
+        # Next, we pull each week individually. This will always get saved.
+        print("INFO: Running Search Term: {}".format(self.params['search_term']))
+        for local_params in self._plan_single_periods(lst_periods):
+
+            d_single = self.pull_data_from_api(local_params)
+            if not d_single:
+                raise ValueError('Problems with period {}'.format(local_params['period_start']))
+
+            for term, result in d_single.items():
+                accumulator.add(term, result)
+
+        # Increment samples taken by 1 - since each period has been sampled individually
+        samples_taken += 1
+
+        # Now do the rolling sample
+        print("INFO: window_size: {}".format(str(num_samples - samples_taken)))
+        for local_params in self._plan_windows(lst_periods, num_samples, samples_taken):
+            # Call the API
+            d_window = self.pull_data_from_api(local_params)
+            # Save the results
+            for term, result in d_window.items():
+                accumulator.add(term, result)
+
+        # When replaying, report the time the original run made its first request
+        if self.replay:
+            query_time = pandas.Timestamp(min(self._replayed_timestamps)).to_pydatetime()
+
+        return accumulator.to_dataframe(query_time)
+
+    def dry_run(self, num_samples=5, qps=1.0, latency=1.0, error_rate=0.0, workers=1):
+
+        """
+        Plans `pull_rolling_window` without making any requests to the API, so quota and worker counts can be
+        sized before running the real thing. The periods are worked out locally (see `_get_periods`).
+
+        :param num_samples: Amount of samples to pull
+        :param qps: Maximum requests per second allowed by your quota
+        :param latency: Average seconds the API takes to answer a single request
+        :param error_rate: Share of requests that fail and are retried (e.g. for exceeding the rate limit)
+        :param workers: Number of requests in flight at once
+        :return: Dictionary with the list of search params that would be queried (`queries`), the total\
+        number of requests (`num_requests`), the expected number of attempts including retries\
+        (`estimated_attempts`) and the expected wall time in seconds (`estimated_seconds`)
+
+        """
+
+        lst_periods = self._get_periods()
+
+        # The same queries, in the same order, that pull_rolling_window makes
+        local_params = deepcopy(self.params)
+        local_params['search_term'] = local_params['search_term'][0]
+        lst_queries = [local_params]
+        lst_queries.extend(self._plan_single_periods(lst_periods))
+        lst_queries.extend(self._plan_windows(lst_periods, num_samples))
+
+        estimated_attempts, estimated_seconds = self._estimate_runtime(
+            len(lst_queries),
+            qps=qps,
+            latency=latency,
+            error_rate=error_rate,
+            workers=workers
+        )
+
+        return {
+            "queries": lst_queries,
+            "num_requests": len(lst_queries),
+            "estimated_attempts": estimated_attempts,
+            "estimated_seconds": estimated_seconds
+        }
@@ -0,0 +1,371 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from contextlib import redirect_stdout
+from collections import defaultdict
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pandas
+
+from search_sampler import SearchSampler
+
+
+class FakeRequest(object):
+
+    """
+    Stands in for a `getTimelinesForHealth` request, returning one point per day, week or month
+    """
+
+    def __init__(self, query, service):
+
+        self.query = query
+        self.service = service
+
+    def execute(self):
+
+        terms = self.query['terms']
+        if not isinstance(terms, list):
+            terms = [terms]
+        terms = terms + self.service.extra_terms
+        dates = self._get_dates()
+
+        lines = []
+        for term in terms:
+            points = []
+            for date in dates:
+                # Every point gets its own value, so samples can be told apart
+                self.service.num_points += 1
+                points.append({'date': date, 'value': self.service.offset + self.service.num_points})
+            lines.append({'term': term, 'points': points})
+
+        return {'lines': lines}
+
+    def _get_dates(self):
+
+        """
+        :return: The dates of each period touching the requested range, formatted the way the API does
+        """
+
+        period_start = datetime.strptime(self.query['time_startDate'], '%Y-%m-%d')
+        period_end = datetime.strptime(self.query['time_endDate'], '%Y-%m-%d')
+        resolution = self.query['timelineResolution']
+
+        dates = []
+        if resolution == 'month':
+            year, month = period_start.year, period_start.month
+            while (year, month) <= (period_end.year, period_end.month):
+                dates.append(datetime(year, month, 1).strftime('%b %Y'))
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        else:
+            if resolution == 'week':
+                step = 7
+                curr_period = period_start - timedelta(days=(period_start.weekday() - self.service.first_weekday) % 7)
+            else:
+                step = 1
+                curr_period = period_start
+            while curr_period <= period_end:
+                dates.append(curr_period.strftime('%b %d %Y'))
+                curr_period += timedelta(days=step)
+        return dates
+
+
+class FakeService(object):
+
+    """
+    Stands in for the API object, counting the requests made to it
+
+    :param offset: Added to every value returned
+    :param extra_terms: Terms returned with every response, on top of those that were asked for
+    :param first_weekday: Day weeks start on, as in `datetime.weekday` (default is Sunday)
+    """
+
+    def __init__(self, offset=0, extra_terms=None, first_weekday=6):
+
+        self.offset = offset
+        self.extra_terms = extra_terms or []
+        self.first_weekday = first_weekday
+        self.num_requests = 0
+        self.num_points = 0
+
+    def getTimelinesForHealth(self, **query):
+
+        self.num_requests += 1
+        return FakeRequest(query, self)
+
+
+class FakeServiceTestCase(unittest.TestCase):
+
+    """
+    Builds samplers that talk to a `FakeService` instead of the API
+    """
+
+    def setUp(self):
+
+        patcher = mock.patch.object(SearchSampler, '_get_service', lambda sampler, api_key: FakeService())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_params(self, **search_params):
+
+        params = {
+            'search_term': ['cough', 'fever'],
+            'region': 'US-DC',
+            'period_start': '2017-01-01',
+            'period_end': '2017-03-01',
+            'period_length': 'week'
+        }
+        params.update(search_params)
+        return params
+
+    def _get_sampler(self, search_name='test', service=None, archive_path=None, **search_params):
+
+        sampler = SearchSampler('key', search_name, self._get_params(**search_params), archive_path=archive_path)
+        if service:
+            sampler.service = service
+        return sampler
+
+
+class TestDryRun(FakeServiceTestCase):
+
+    def test_num_queries_matches_requests(self):
+
+        for period_length, period_start, period_end in [
+            ('week', '2017-01-01', '2017-03-01'),
+            ('week', '2017-01-04', '2017-03-01'),
+            ('day', '2017-01-01', '2017-01-20'),
+            ('day', '2017-01-04', '2017-01-20'),
+            ('month', '2017-01-01', '2017-05-31'),
+            ('month', '2017-01-15', '2017-05-10')
+        ]:
+            for num_samples in [1, 2, 3, 5, 8]:
+                sampler = self._get_sampler(
+                    period_length=period_length,
+                    period_start=period_start,
+                    period_end=period_end
+                )
+                plan = sampler.dry_run(num_samples=num_samples)
+                output = io.StringIO()
+                with redirect_stdout(output):
+                    sampler.pull_rolling_window(num_samples=num_samples)
+                self.assertEqual(len(plan['queries']), sampler.service.num_requests)
+                self.assertEqual(plan['num_requests'], sampler.service.num_requests)
+                self.assertNotIn('WARNING', output.getvalue())
+
+    def test_period_mismatch_warns(self):
+
+        # The API starting its weeks on a Monday would throw off every query after the first
+        sampler = self._get_sampler(period_start='2017-01-04', service=FakeService(first_weekday=0))
+        output = io.StringIO()
+        with redirect_stdout(output):
+            sampler.pull_rolling_window(num_samples=3)
+        self.assertIn('WARNING: The periods returned by the API do not match', output.getvalue())
+
+    def test_dry_run_makes_no_requests(self):
+
+        sampler = self._get_sampler()
+        sampler.dry_run(num_samples=5)
+        self.assertEqual(sampler.service.num_requests, 0)
+
+    def test_estimate_without_errors(self):
+
+        attempts, seconds = SearchSampler._estimate_runtime(10, qps=1, latency=1, error_rate=0, workers=1)
+        self.assertEqual(attempts, 10)
+        self.assertEqual(seconds, 10)
+
+    def test_estimate_rejects_invalid_model(self):
+
+        for kwargs in [
+            {'qps': 0},
+            {'workers': 0},
+            {'latency': -1},
+            {'error_rate': 1}
+        ]:
+            model = {'qps': 1, 'latency': 1, 'error_rate': 0, 'workers': 1}
+            model.update(kwargs)
+            with self.assertRaises(ValueError):
+                SearchSampler._estimate_runtime(10, **model)
+
+
+class TestPullRollingWindow(FakeServiceTestCase):
+
+    def _pull_with_responses(self, sampler, num_samples):
+
+        """
+        :return: 2-tuple containing the output of `pull_rolling_window` and every result it pulled, in order
+        """
+
+        responses = []
+        pull_data_from_api = SearchSampler.pull_data_from_api
+
+        def record_pull(sampler, *args, **kwargs):
+            d_results = pull_data_from_api(sampler, *args, **kwargs)
+            responses.append(d_results)
+            return d_results
+
+        with mock.patch.object(SearchSampler, 'pull_data_from_api', record_pull):
+            df = sampler.pull_rolling_window(num_samples=num_samples)
+        return df, responses
+
+    def _get_expected(self, responses, num_samples):
+
+        """
+        Builds the output the way `pull_rolling_window` did before it had an accumulator: a dict of\
+        per-period lists, expanded into one dict per row
+        """
+
+        lst_periods = list(responses[0].values())[0]['period'].tolist()
+        single_responses = responses[1:len(lst_periods) + 1]
+        window_responses = responses[len(lst_periods) + 1:]
+
+        d_periods = {}
+        for d_results in single_responses:
+            for term, df in d_results.items():
+                for index, row in df.iterrows():
+                    d_periods.setdefault(term, defaultdict(list))[row['period']].append(row['value'])
+        for d_results in window_responses:
+            for term, df in d_results.items():
+                for index, row in df.iterrows():
+                    if row['period'] in lst_periods:
+                        d_periods[term][row['period']].append(row['value'])
+
+        rows = []
+        for term, timestamps in d_periods.items():
+            for timestamp, samples in timestamps.items():
+                for i, sample in enumerate(samples[:num_samples]):
+                    rows.append({"term": term, "period": timestamp, "sample": i, "value": sample})
+        return pandas.DataFrame(rows)
+
+    def test_matches_list_of_dicts_output(self):
+
+        for num_samples in [1, 2, 3, 5]:
+            sampler = self._get_sampler()
+            df, responses = self._pull_with_responses(sampler, num_samples)
+            pandas.testing.assert_frame_equal(
+                df.drop(columns='query_time'),
+                self._get_expected(responses, num_samples)
+            )
+
+    def test_extra_sample_is_dropped(self):
+
+        # With two samples the window size is bumped from 1 to 2, so each period is drawn three times
+        sampler = self._get_sampler()
+        df, responses = self._pull_with_responses(sampler, 2)
+        self.assertEqual(df['sample'].max(), 1)
+        self.assertTrue((df.groupby(['term', 'period'])['sample'].count() == 2).all())
+
+    def test_periods_outside_range_are_ignored(self):
+
+        sampler = self._get_sampler()
+        df, responses = self._pull_with_responses(sampler, 5)
+        lst_periods = list(responses[0].values())[0]['period'].tolist()
+        window_periods = set(list(responses[-1].values())[0]['period'])
+        self.assertFalse(window_periods.issubset(lst_periods))
+        self.assertEqual(sorted(df['period'].unique()), lst_periods)
+
+    def test_unrequested_terms_are_kept(self):
+
+        sampler = self._get_sampler(service=FakeService(extra_terms=['flu']))
+        df, responses = self._pull_with_responses(sampler, 3)
+        self.assertEqual(df['term'].unique().tolist(), ['cough', 'fever', 'flu'])
+        self.assertEqual(len(df[df['term'] == 'flu']), len(df[df['term'] == 'cough']))
+        pandas.testing.assert_frame_equal(df.drop(columns='query_time'), self._get_expected(responses, 3))
+
+    def test_integer_values_stay_integers(self):
+
+        df = self._get_sampler(search_term=['cough'], period_end='2017-02-01').pull_rolling_window(num_samples=3)
+        self.assertEqual(df['value'].dtype.kind, 'i')
+        self.assertEqual(df.groupby('period')['sample'].count().tolist(), [3] * 5)
+
+
+
+class TestArchive(FakeServiceTestCase):
+
+    def setUp(self):
+
+        super(TestArchive, self).setUp()
+        self.archive_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_path)
+
+    def _archive_run(self, search_name='test', service=None, num_samples=3):
+
+        sampler = self._get_sampler(search_name, service=service, archive_path=self.archive_path)
+        df = sampler.pull_rolling_window(num_samples=num_samples)
+        sampler.close_archive()
+        return df
+
+    def _get_replay_sampler(self, search_name='test', **search_params):
+
+        return SearchSampler(
+            None,
+            search_name,
+            self._get_params(**search_params),
+            archive_path=self.archive_path,
+            replay=True
+        )
+
+    def test_replay_matches_original_run(self):
+
+        df = self._archive_run()
+        sampler = self._get_replay_sampler()
+        df_replay = sampler.pull_rolling_window(num_samples=3)
+
+        self.assertIsNone(sampler.service)
+        pandas.testing.assert_frame_equal(df.drop(columns='query_time'), df_replay.drop(columns='query_time'))
+
+    def test_replay_query_time_is_earliest_archived_request(self):
+
+        df = self._archive_run()
+        df_replay = self._get_replay_sampler().pull_rolling_window(num_samples=3)
+
+        archive_folder = os.path.join(self.archive_path, 'US-DC')
+        segment_path = os.path.join(archive_folder, os.listdir(archive_folder)[0])
+        timestamps = [json.loads(line)['timestamp'] for line in SearchSampler._read_segment(segment_path)]
+        self.assertEqual(df_replay['query_time'].iloc[0], pandas.Timestamp(min(timestamps)))
+        self.assertGreaterEqual(df_replay['query_time'].iloc[0], df['query_time'].iloc[0])
+
+    def test_replay_reads_unfinished_segment(self):
+
+        sampler = self._get_sampler(archive_path=self.archive_path)
+        df = sampler.pull_rolling_window(num_samples=3)
+        df_replay = self._get_replay_sampler().pull_rolling_window(num_samples=3)
+        pandas.testing.assert_frame_equal(df.drop(columns='query_time'), df_replay.drop(columns='query_time'))
+        sampler.close_archive()
+
+    def test_replay_skips_searches_sharing_a_prefix(self):
+
+        df = self._archive_run('test')
+        self._archive_run('test-foo', service=FakeService(offset=1000))
+        df_replay = self._get_replay_sampler('test').pull_rolling_window(num_samples=3)
+        pandas.testing.assert_frame_equal(df.drop(columns='query_time'), df_replay.drop(columns='query_time'))
+
+    def test_later_responses_win(self):
+
+        self._archive_run()
+        df = self._archive_run(service=FakeService(offset=1000))
+        df_replay = self._get_replay_sampler().pull_rolling_window(num_samples=3)
+        pandas.testing.assert_frame_equal(df.drop(columns='query_time'), df_replay.drop(columns='query_time'))
+
+    def test_missing_request_raises(self):
+
+        self._archive_run()
+        with self.assertRaises(ValueError):
+            self._get_replay_sampler(period_end='2017-04-01').pull_rolling_window(num_samples=3)
+
+    def test_missing_archive_raises(self):
+
+        with self.assertRaises(ValueError):
+            self._get_replay_sampler()
+
+    def test_replay_requires_archive_path(self):
+
+        with self.assertRaises(SystemError):
+            SearchSampler(None, 'test', self._get_params(), replay=True)
+
+
+if __name__ == '__main__':
+    unittest.main()